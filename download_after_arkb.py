@@ -1,100 +1,434 @@
 #!/usr/bin/env python3
 import asyncio
+import hashlib
+import os
 import pathlib
 import signal
+import sqlite3
 import stat
 import sys
 
 try:
     import aiohttp
-    import aiofiles
+    import dulwich.diff_tree
     import dulwich.repo
     import tqdm.asyncio
 except:
     import subprocess
-    subprocess.check_call([sys.executable, '-m', 'pip', 'install', 'aiohttp', 'aiofiles', 'dulwich', 'tqdm'])
+    subprocess.check_call([sys.executable, '-m', 'pip', 'install', 'aiohttp', 'dulwich', 'tqdm'])
     import aiohttp
-    import aiofiles
+    import dulwich.diff_tree
     import dulwich.repo
     import tqdm.asyncio
 
+HASHES = {
+    'MD5': hashlib.md5,
+    'SHA1': hashlib.sha1,
+    'SHA224': hashlib.sha224,
+    'SHA256': hashlib.sha256,
+    'SHA384': hashlib.sha384,
+    'SHA512': hashlib.sha512,
+    'SHA3_224': hashlib.sha3_224,
+    'SHA3_256': hashlib.sha3_256,
+    'SHA3_384': hashlib.sha3_384,
+    'SHA3_512': hashlib.sha3_512,
+    'BLAKE2B160': lambda: hashlib.blake2b(digest_size=20),
+    'BLAKE2B224': lambda: hashlib.blake2b(digest_size=28),
+    'BLAKE2B256': lambda: hashlib.blake2b(digest_size=32),
+    'BLAKE2B384': lambda: hashlib.blake2b(digest_size=48),
+    'BLAKE2B512': lambda: hashlib.blake2b(digest_size=64),
+    'BLAKE2S160': lambda: hashlib.blake2s(digest_size=20),
+    'BLAKE2S224': lambda: hashlib.blake2s(digest_size=28),
+    'BLAKE2S256': lambda: hashlib.blake2s(digest_size=32),
+}
+
+class ScanCache:
+    '''What earlier runs found in the HEAD tree and git-annex branch, keyed by the trees they scanned,
+    so a rerun only looks at what changed since.
+    annexed maps each annexed path in HEAD to its key and object location, weblogs maps keys to
+    their .log.web blobs in the branch, or NULL if they have none, and present lists keys whose objects were found,
+    until their location logs change.'''
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, timeout=60)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS trees (name TEXT PRIMARY KEY, tree TEXT)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS annexed (path TEXT PRIMARY KEY, key TEXT, location TEXT, size INTEGER)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS weblogs (key TEXT PRIMARY KEY, blob TEXT)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS present (key TEXT PRIMARY KEY)')
+
+    def tree(self, name):
+        row = self.db.execute('SELECT tree FROM trees WHERE name = ?', (name,)).fetchone()
+        return row and row[0].encode()
+
+    def set_tree(self, name, tree):
+        self.db.execute('INSERT OR REPLACE INTO trees VALUES (?, ?)', (name, tree.decode()))
+
+def unescape_key(filename):
+    return filename.replace('%', '/').replace('&c', ':').replace('&s', '%').replace('&a', '&')
+
+def branch_log_path(key, suffix):
+    '''The path of a key's log in the git-annex branch: hashDirLower, then the key escaped as a filename.'''
+    digest = hashlib.md5(key.encode()).hexdigest()
+    filename = key.replace('&', '&a').replace('%', '&s').replace(':', '&c').replace('/', '%')
+    return f'{digest[:3]}/{digest[3:6]}/{filename}{suffix}'
+
+class Download:
+    '''A key being written into a preallocated file beside its object, then hashed and renamed into place.
+    Finished ranges are appended to a sidecar journal, so an interrupted download resumes where it stopped.
+    The key's hash is updated whenever the ranges finished so far extend the verified prefix.'''
+    def __init__(self, key, location, size):
+        self.key = key
+        self.location = location
+        self.size = size
+        self.tmp = location.with_name(location.name + '.download')
+        self.journal_path = location.with_name(location.name + '.download.journal')
+        self.url = None
+        self._reset()
+        location.parent.mkdir(exist_ok=True, parents=True)
+        self.fd = os.open(self.tmp, os.O_RDWR | os.O_CREAT, 0o644)
+        os.ftruncate(self.fd, size)
+        try:
+            with open(self.journal_path, 'rt') as journal:
+                for line in journal:
+                    if not line.endswith('\n'):
+                        break # cut off by a crash
+                    self._replay(*line.split())
+        except FileNotFoundError:
+            pass
+        self.journal = open(self.journal_path, 'at')
+        self._advance_hash()
+
+    def _reset(self):
+        backend = self.key.split('-', 1)[0]
+        if backend.endswith('E'):
+            backend = backend[:-1]
+        self.hash = HASHES[backend]() if backend in HASHES else None
+        self.hashed = 0
+        self.ranges = {}
+        self.subchunk_length = None
+
+    def _replay(self, event, *params):
+        if event == 'url':
+            self.url = params[0]
+            self._reset()
+        elif event == 'length':
+            self.subchunk_length = int(params[0])
+        elif event == 'done':
+            index, offset, length = (int(param) for param in params)
+            self.ranges[index] = (offset, length)
+
+    def _write_journal(self, *event):
+        self.journal.write(' '.join(str(param) for param in event) + '\n')
+        self.journal.flush()
+        self._replay(*(str(param) for param in event))
+
+    def start(self, url, restart = False):
+        '''Begin downloading from url, keeping what was finished if the interrupted download used the same url.'''
+        if restart or url != self.url:
+            self._write_journal('url', url)
+
+    def prefix(self):
+        '''The length of the finished data at the start of the file.'''
+        starts = {offset: length for offset, length in self.ranges.values()}
+        end = 0
+        while starts.get(end):
+            end += starts[end]
+        return end
+
+    def offset(self, index):
+        '''Where subchunk index starts, if known yet. Every subchunk but the last has the same length.'''
+        if index == 0:
+            return 0
+        elif self.subchunk_length is not None:
+            return index * self.subchunk_length
+        else:
+            return None
+
+    def learn_subchunk_length(self, length):
+        if self.subchunk_length is None:
+            self._write_journal('length', length)
+
+    def done(self, index, offset, length):
+        # the data is not synced before it is journalled; data lost with the page cache fails the hash and restarts the key
+        self._write_journal('done', index, offset, length)
+        self._advance_hash()
+
+    def _advance_hash(self):
+        if self.hash is None:
+            return
+        starts = {offset: length for offset, length in self.ranges.values()}
+        while self.hashed in starts and starts[self.hashed] > 0:
+            end = self.hashed + starts[self.hashed]
+            while self.hashed < end:
+                data = os.pread(self.fd, min(1024 * 1024, end - self.hashed), self.hashed)
+                self.hash.update(data)
+                self.hashed += len(data)
+
+    def finish(self):
+        '''Check the key's hash and move the file to the object path, or discard it if the hash does not match.'''
+        if self.hash is not None:
+            digest = self.hash.hexdigest()
+            name = self.key.split('--', 1)[1]
+            if self.hashed != self.size or name[:len(digest)] != digest:
+                self.close()
+                os.unlink(self.tmp)
+                os.unlink(self.journal_path)
+                raise ValueError(f'{self.key}: downloaded data does not match the key')
+        os.fsync(self.fd)
+        self.close()
+        os.replace(self.tmp, self.location)
+        os.unlink(self.journal_path)
+
+    def close(self):
+        self.journal.close()
+        os.close(self.fd)
+
 class amain:
-    def __init__(self, repo_path, gateway = 'https://arweave.net/', files_at_once = 3, chunks_at_once = 32):
+    def __init__(self, repo_path, gateway = 'https://arweave.net/', files_at_once = 3, chunks_at_once = 32, buffer_bytes = 64 * 1024 * 1024):
         self.repo = dulwich.repo.Repo(repo_path)
         self.gateway = gateway
         self.files_at_once = asyncio.Semaphore(files_at_once)
         self.chunks_at_once = asyncio.Semaphore(chunks_at_once)
+        # bytes held in memory by subchunks that do not know their offset yet
+        self.buffer_bytes = buffer_bytes
+        self.buffered = 0
+        self.buffer_condition = asyncio.Condition()
 
     async def _bounded(self, sem, coro):
         async with sem:
             return await coro
 
-    async def _fetch_chunk(self, ditemid, progress):
-        subchunks = []
+    async def _fetch_chunk(self, download, index, count, ditemid, progress):
+        '''Write subchunk index of count at its offset as it arrives.
+        Until its offset is known, which takes the length of some other subchunk, its data is buffered.'''
+        last = index == count - 1
         async with self.http.get(self.gateway + ditemid) as response:
-            async for subchunk in response.content.iter_any():
-                subchunks.append(subchunk)
-                progress.update(len(subchunk))
-        return subchunks
+            response.raise_for_status()
+            length = response.content_length
+            if length is not None:
+                if last:
+                    offset = download.size - length
+                else:
+                    download.learn_subchunk_length(length)
+                    async with self.buffer_condition:
+                        self.buffer_condition.notify_all()
+            buffered = []
+            received = 0
+            async for data in response.content.iter_any():
+                offset = download.offset(index) if not last or length is None else download.size - length
+                if offset is None:
+                    async with self.buffer_condition:
+                        while self.buffered > 0 and self.buffered + len(data) > self.buffer_bytes and download.offset(index) is None:
+                            await self.buffer_condition.wait()
+                        self.buffered += len(data)
+                    buffered.append(data)
+                else:
+                    await self._flush(download, buffered, offset)
+                    os.pwrite(download.fd, data, offset + received)
+                received += len(data)
+                progress.update(len(data))
+        if not last:
+            download.learn_subchunk_length(received)
+            offset = download.offset(index)
+        else:
+            offset = download.size - received
+        await self._flush(download, buffered, offset)
+        download.done(index, offset, received)
+        async with self.buffer_condition:
+            self.buffer_condition.notify_all()
+
+    async def _flush(self, download, buffered, offset):
+        position = offset
+        for data in buffered:
+            os.pwrite(download.fd, data, position)
+            position += len(data)
+        if buffered:
+            async with self.buffer_condition:
+                self.buffered -= sum(len(data) for data in buffered)
+                self.buffer_condition.notify_all()
+            buffered.clear()
+
+    async def _fetch_subchunks(self, download, ditemid, progress):
+        subditemids = [
+            subditemid.decode().strip()
+            async for subfolder in (await self.http.get(self.gateway + ditemid)).content
+            async for subditemid in (await self.http.get(self.gateway + ditemid + '/' + subfolder.decode().strip())).content
+        ]
+        loop = asyncio.get_event_loop()
+        chunks = []
+        for index, subditemid in enumerate(subditemids):
+            if index in download.ranges:
+                continue
+            # a task is only made once a slot is free, so tasks do not pile up for large keys
+            await self.chunks_at_once.acquire()
+            chunk = loop.create_task(self._fetch_chunk(download, index, len(subditemids), subditemid, progress))
+            chunk.add_done_callback(lambda chunk: self.chunks_at_once.release())
+            chunks.append(chunk)
+        try:
+            await asyncio.gather(*chunks)
+        finally:
+            for chunk in chunks:
+                chunk.cancel()
+
+    async def _fetch_web(self, download, url, progress):
+        # written in order, so the ranges finished so far are all at the start
+        journalled = download.prefix()
+        headers = {'Range': f'bytes={journalled}-'} if journalled else {}
+        async with self.http.get(url, headers=headers) as response:
+            response.raise_for_status()
+            if journalled and response.status != 206:
+                download.start(url, restart = True)
+                progress.update(-journalled)
+                journalled = 0
+            position = journalled
+            async for data in response.content.iter_any():
+                os.pwrite(download.fd, data, position)
+                position += len(data)
+                progress.update(len(data))
+                if position - journalled >= 8 * 1024 * 1024:
+                    download.done(len(download.ranges), journalled, position - journalled)
+                    journalled = position
+        if position > journalled:
+            download.done(len(download.ranges), journalled, position - journalled)
 
     async def _fetch_file(self, logblob, name, path, size):
-        path.parent.mkdir(exist_ok=True,parents=True)
-        async with aiofiles.open(str(path), 'wb') as ofh:
-          with tqdm.tqdm(desc=name, total=size, unit='B', unit_scale=True, unit_divisor=1024) as progress:
-            for line in logblob.splitlines():
-                for pfx in (b'https://', b'arkb-subprocess://'):
-                    idx = line.find(pfx)
-                    if idx >= 0:
-                        url = line[idx:].strip().decode()
+        download = Download(path.name, path, size)
+        try:
+            with tqdm.tqdm(desc=name, total=size, initial=sum(length for offset, length in download.ranges.values()), unit='B', unit_scale=True, unit_divisor=1024) as progress:
+                exception = None
+                for line in logblob.splitlines():
+                    if line.split(b' ', 2)[1:2] == [b'0']:
+                        continue # recorded missing
+                    for pfx in (b'https://', b'arkb-subprocess://'):
+                        idx = line.find(pfx)
+                        if idx >= 0:
+                            url = line[idx:].strip().decode()
+                            break
+                    else:
+                        continue
+                    download.start(url)
+                    try:
+                        if pfx == b'arkb-subprocess://':
+                            await self._fetch_subchunks(download, url[len(pfx):], progress)
+                        else:
+                            await self._fetch_web(download, url, progress)
                         break
+                    except aiohttp.ClientError as exc:
+                        exception = exc
                 else:
-                    continue
-                if pfx == b'arkb-subprocess://':
-                    ditemid = url[len(pfx):]
-                    loop = asyncio.get_event_loop()
-                    chunks = [
-                        loop.create_task(self._bounded(self.chunks_at_once, self._fetch_chunk(subditemid.decode().strip(), progress)))
-                        async for subfolder in (await self.http.get(self.gateway + ditemid)).content
-                        async for subditemid in (await self.http.get(self.gateway + ditemid + '/' + subfolder.decode().strip())).content
-                    ]
-                    #self.queued_tasks.append(chunks)
-                    for chunk in chunks:
-                        subchunks = await chunk
-                        for subchunk in subchunks:
-                            await ofh.write(subchunk)
-                else:
-                    response = await self.http.get(url)
-                    async for chunk in response.content.iter_any():
-                        await ofh.write(chunk)
-                        progress.update(len(chunk))
+                    raise exception or KeyError(f'{path.name}: no url to download from')
+        except:
+            download.close()
+            raise
+        download.finish()
 
-    async def __call__(self):
-        key_name_path_sizes = {}
-        key_logs = {}
+    def _scan(self, emit):
+        '''Call emit(key, name, location, size, weblog) for each key in HEAD whose object is missing and that has web urls.
+        Only the trees that changed since the last scan are walked. Runs in its own thread, as dulwich blocks.'''
+        cache = ScanCache(os.path.join(self.repo.controldir(), 'annex', 'download_after_arkb.sqlite3'))
         refs = self.repo.refs.as_dict()
-        head = self.repo[self.repo.head()]
-        for name, mode, sha in dulwich.object_store.iter_tree_contents(self.repo, head.tree):
-            if stat.S_ISLNK(mode):
-                location = self.repo[sha].data.decode()
-                location = (pathlib.Path(self.repo.path) / name.decode()).parent / location
-                location = location.resolve()
-                key = location.name
-                size = int(key.split('--',1)[0].split('-s')[-1])
-                if not location.exists() or location.stat().st_size != size:
-                    key_name_path_sizes[key] = name.decode(), location, size
+        head_tree = self.repo[self.repo.head()].tree
         gitannex = [val for ref, val in refs.items() if ref.endswith(b'git-annex')][0]
-        gitannex = self.repo[gitannex]
-        for name, mode, sha in dulwich.object_store.iter_tree_contents(self.repo, gitannex.tree):
-            if name.endswith(b'.log.web'):
-                key = name[name.rfind(b'/')+1:-len(b'.log.web')].decode()
-                if key in key_name_path_sizes:
-                    key_logs[key] = self.repo[sha]
+        annex_tree = self.repo[gitannex].tree
+        emitted = set()
+
+        def weblog(key):
+            row = cache.db.execute('SELECT blob FROM weblogs WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                try:
+                    mode, sha = dulwich.object_store.tree_lookup_path(self.repo.__getitem__, annex_tree, branch_log_path(key, '.log.web').encode())
+                    row = (sha.decode(),)
+                except KeyError:
+                    row = (None,)
+                cache.db.execute('INSERT OR REPLACE INTO weblogs VALUES (?, ?)', (key, row[0]))
+            return row[0] and self.repo[row[0].encode()].data
+
+        def check(name, key, location, size):
+            if key in emitted:
+                return
+            emitted.add(key)
+            if cache.db.execute('SELECT 1 FROM present WHERE key = ?', (key,)).fetchone():
+                return
+            if os.path.exists(location) and os.stat(location).st_size == size:
+                cache.db.execute('INSERT OR IGNORE INTO present VALUES (?)', (key,))
+                return
+            log = weblog(key)
+            if log is not None:
+                emit(key, name, pathlib.Path(location), size, log)
+
+        def annexed(name, sha):
+            location = self.repo[sha].data.decode()
+            location = (pathlib.Path(self.repo.path) / name.decode()).parent / location
+            location = location.resolve()
+            key = location.name
+            size = int(key.split('--',1)[0].split('-s')[-1])
+            cache.db.execute('INSERT OR REPLACE INTO annexed VALUES (?, ?, ?, ?)', (name.decode(), key, str(location), size))
+            check(name.decode(), key, str(location), size)
+
+        with cache.db:
+            # the web and location logs that changed in the branch
+            old_annex_tree = cache.tree('git-annex')
+            if old_annex_tree is None:
+                cache.db.execute('DELETE FROM weblogs')
+                cache.db.execute('DELETE FROM present')
+            elif old_annex_tree != annex_tree:
+                for change in dulwich.diff_tree.tree_changes(self.repo.object_store, old_annex_tree, annex_tree):
+                    for entry in (change.old, change.new):
+                        # a missing side is None in newer dulwich, and an entry of Nones in older
+                        if entry is None or entry.path is None or b'/' not in entry.path:
+                            continue
+                        if entry.path.endswith(b'.log.web'):
+                            key = entry.path[entry.path.rfind(b'/')+1:-len(b'.log.web')].decode()
+                            # looked up again when next needed
+                            cache.db.execute('DELETE FROM weblogs WHERE key = ?', (unescape_key(key),))
+                        elif entry.path.endswith(b'.log'):
+                            key = entry.path[entry.path.rfind(b'/')+1:-len(b'.log')].decode()
+                            # its object may have been dropped, so it is checked for again
+                            cache.db.execute('DELETE FROM present WHERE key = ?', (unescape_key(key),))
+            cache.set_tree('git-annex', annex_tree)
+
+            # the annexed files that changed in HEAD, checked as they are found so downloads start during the walk
+            old_head_tree = cache.tree('HEAD')
+            if old_head_tree is None:
+                cache.db.execute('DELETE FROM annexed')
+                for name, mode, sha in dulwich.object_store.iter_tree_contents(self.repo, head_tree):
+                    if stat.S_ISLNK(mode):
+                        annexed(name, sha)
+            elif old_head_tree != head_tree:
+                for change in dulwich.diff_tree.tree_changes(self.repo.object_store, old_head_tree, head_tree):
+                    if change.old is not None and change.old.path is not None and stat.S_ISLNK(change.old.mode):
+                        cache.db.execute('DELETE FROM annexed WHERE path = ?', (change.old.path.decode(),))
+                    if change.new is not None and change.new.path is not None and stat.S_ISLNK(change.new.mode):
+                        annexed(change.new.path, change.new.sha)
+
+            # files that were already missing or have lost their objects' presence records
+            for name, key, location, size in cache.db.execute('SELECT path, key, location, size FROM annexed WHERE key NOT IN (SELECT key FROM present)').fetchall():
+                check(name, key, location, size)
+            cache.set_tree('HEAD', head_tree)
+        cache.db.close()
+
+    async def __call__(self):
+        loop = asyncio.get_running_loop()
+        found = asyncio.Queue()
+        def emit(*item):
+            loop.call_soon_threadsafe(found.put_nowait, item)
+        def scan():
+            try:
+                self._scan(emit)
+            finally:
+                loop.call_soon_threadsafe(found.put_nowait, None)
+        scanning = loop.run_in_executor(None, scan)
         async with aiohttp.ClientSession() as http:
             self.http = http
-            return await asyncio.gather(*[
-                self._bounded(self.files_at_once, self._fetch_file(key_logs[key], *key_name_path_sizes[key]))
-                for key in key_logs
-            ])
+            downloads = []
+            while True:
+                item = await found.get()
+                if item is None:
+                    break
+                key, name, location, size, log = item
+                downloads.append(loop.create_task(self._bounded(self.files_at_once, self._fetch_file(log, name, location, size))))
+            await scanning
+            return await asyncio.gather(*downloads)
 
 if __name__ == '__main__':
     # This restores the default Ctrl+C signal handler, which just kills the process
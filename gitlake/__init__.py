@@ -19,40 +19,119 @@ class GitAnnexESRP(threading.Thread):
     VERY_EXPENSIVE = 1000
     ADD_ENCRYPTED = 50
 
+  # number of worker threads running jobs when git-annex negotiates ASYNC
+  # 0 handles every request on the main thread; a subclass whose handlers and
+  # shared state are safe to use from several threads at once may raise it
+  async_workers = 0
+
+  # requests that may run concurrently on the worker pool under ASYNC
+  ASYNC_COMMANDS = ('TRANSFER', 'CHECKPRESENT', 'REMOVE')
+
   def __init__(self, mockinput = None):
     self.stdin = mockinput if mockinput else sys.stdin
     try:
       threading.Thread.__init__(self)
       self.send_lock = threading.RLock()
-      self.replies_queue = Queue.Queue()
+      self.replies_lock = threading.Lock()
+      self.replies_queues = {}
       self.handling_queue = Queue.Queue()
+      self.jobs_queue = Queue.Queue()
+      self.job_local = threading.local()
+      self.workers = []
+      self.url_index = None
+      self.url_index_lock = threading.Lock()
+      self.dedup_cache = None
+      self.dedup_cache_lock = threading.Lock()
+      self.git_dir = None
+      self.uuid = None
       self.incomingError = None
       self.extensions = set()
       self.start()
       self.VERSION(1)
       while self.is_alive() or not self.handling_queue.empty():
         try:
-          command, args = self.handling_queue.get(True, 1)
+          job, command, args = self.handling_queue.get(True, 1)
         except Queue.Empty:
           continue
-        try:
-          handler = getattr(self, 'on' + command)
-          if args != None:
-            argspec = inspect.getfullargspec(handler)
-            if argspec[1] != None:
-              nArgs = -1
-            else:
-              nArgs = len(argspec[0]) - 1
-            handler(*(args.split(' ', nArgs)))
-          else:
-            handler()
-        except (AttributeError, NotImplementedError) as e:
-          self.DEBUG('processing error ' + str(type(e)) + ' as unsupported request: ' + str(e))
-          self.UNSUPPORTED_REQUEST()
+        if job is not None and command in self.ASYNC_COMMANDS and self.workers:
+          self.jobs_queue.put((job, command, args))
+        else:
+          self.handle(job, command, args)
     except Exception:
       self.exception()
+    for worker in self.workers:
+      self.jobs_queue.put(None)
+    for worker in self.workers:
+      worker.join()
     self.finish()
 
+  # run the handler for a single request, replies are tagged with job
+  def handle(self, job, command, args):
+    self.job_local.job = job
+    try:
+      handler = getattr(self, 'on' + command)
+      if args != None:
+        argspec = inspect.getfullargspec(handler)
+        if argspec[1] != None:
+          nArgs = -1
+        else:
+          nArgs = len(argspec[0]) - 1
+        handler(*(args.split(' ', nArgs)))
+      else:
+        handler()
+    except (AttributeError, NotImplementedError) as e:
+      self.DEBUG('processing error ' + str(type(e)) + ' as unsupported request: ' + str(e))
+      self.UNSUPPORTED_REQUEST()
+    except Exception:
+      if job is None:
+        raise
+      self.exception()
+    finally:
+      self.job_local.job = None
+
+  # worker pool thread body for ASYNC jobs
+  def work(self):
+    while True:
+      item = self.jobs_queue.get()
+      if item is None:
+        break
+      self.handle(*item)
+
+  # the job number of the request being handled by the calling thread
+  def currentJob(self):
+    return getattr(self.job_local, 'job', None)
+
+  # wrap func to run on another thread as part of the calling thread's job, so its messages are tagged with it too
+  # once the event detached is set, the thread sends nothing more, so it may outlive the job without
+  # speaking after the job's reply; set it with endJobThreads
+  def jobThread(self, func, detached = None):
+    job = self.currentJob()
+    def run(*params, **kwparams):
+      self.job_local.job = job
+      self.job_local.detached = detached
+      try:
+        return func(*params, **kwparams)
+      finally:
+        self.job_local.job = None
+        self.job_local.detached = None
+    return run
+
+  # silence the threads started with jobThread(func, detached), after any message they are sending
+  def endJobThreads(self, detached):
+    with self.send_lock:
+      detached.set()
+
+  def isDetached(self):
+    detached = getattr(self.job_local, 'detached', None)
+    return detached is not None and detached.is_set()
+
+  # queue of replies awaited by a job; None is the queue outside any job
+  def repliesQueue(self, job):
+    with self.replies_lock:
+      if job not in self.replies_queues:
+        self.replies_queues[job] = Queue.Queue()
+      return self.replies_queues[job]
+
   class MessageReply:
     def __init__(self, **replies):
       self.event = threading.Event()
@@ -85,29 +164,37 @@ class GitAnnexESRP(threading.Thread):
 
   # receive lines and process them
   def run(self):
-    reply = None
+    replies = {}
     while True:
       try:
         line = self.stdin.readline()
         if line == "":
           break
+        line = line[:-1]
+        # ASYNC prefixes messages belonging to a job with J <n>
+        job = None
+        if line.startswith('J '):
+          job, line = (line[2:].split(' ', 1) + [''])[:2]
         # funny tricks here make sure args = None if no args are provided
-        line = line[:-1].split(' ',1) + [None]
+        line = line.split(' ',1) + [None]
         command, args = line[:2]
 
         # see if anybody was waiting for this command
+        reply = replies.get(job)
         if reply == None:
           try:
-            reply = self.replies_queue.get_nowait()
+            reply = self.repliesQueue(job).get_nowait()
           except Queue.Empty:
             pass
         if reply != None and reply.matches(command):
           if reply.process(command, args):
             reply = None
+          replies[job] = reply
           continue
+        replies[job] = reply
 
         # nobody was waiting, pass it to handler
-        self.handling_queue.put((command, args))
+        self.handling_queue.put((job, command, args))
         self.running = False
 
       except Exception:
@@ -117,14 +204,26 @@ class GitAnnexESRP(threading.Thread):
     if self.incomingError == None:
       self.incomingError = "Connection closed"
 
-    while not self.replies_queue.empty():
-      self.replies_queue.get().fail(self.incomingError)
+    for reply in replies.values():
+      if reply != None:
+        reply.fail(self.incomingError)
+    with self.replies_lock:
+      queues = list(self.replies_queues.values())
+    for queue in queues:
+      while not queue.empty():
+        queue.get().fail(self.incomingError)
 
 
 
   # send a message without waiting for a reply
+  # messages sent while handling a job are prefixed with its number
   def send(self, *args):
+    job = self.currentJob()
+    if job is not None:
+      args = ('J', job) + args
     with self.send_lock:
+      if self.isDetached():
+        return
       sys.stdout.write(" ".join(map(str,args)))
       sys.stdout.write("\n")
       sys.stdout.flush()
@@ -133,7 +232,9 @@ class GitAnnexESRP(threading.Thread):
   # **replies is in format of COMMAND=argcount
   def getReply(self, reply, *args):
     with self.send_lock:
-      self.replies_queue.put(reply)
+      if self.isDetached():
+        raise Exception('job has ended')
+      self.repliesQueue(self.currentJob()).put(reply)
       self.send(*args)
     reply.event.wait()
     if reply.error:
@@ -201,28 +302,84 @@ class GitAnnexESRP(threading.Thread):
   # if public urls are available, esrp should document that it can be
   # used in readonly mode, allowing retrieval of files when not installed
   def SETURLPRESENT(self, key, url):
+    if self.urlIndex():
+      self.url_index.set_present(key, url)
     self.send('SETURLPRESENT', key, url)
 
   # records that key may not longer be downloaded from specified URL
   def SETURLMISSING(self, key, url):
+    if self.urlIndex():
+      self.url_index.set_missing(key, url)
     self.send('SETURLMISSING', key, url)
 
   # records an URI where <key> may be downloaded from; something the
   # CLAIMURL handler will claim
   def SETURIPRESENT(self, key, uri):
+    if self.urlIndex():
+      self.url_index.set_present(key, uri, uri=True)
     self.send('SETURIPRESENT', key, uri)
 
   # records that key is no longer available at uri
   def SETURIMISSING(self, key, uri):
+    if self.urlIndex():
+      self.url_index.set_missing(key, uri, uri=True)
     self.send('SETURIMISSING', key, uri)
 
   # gets urls for <key> which start with <prefix>
-  # reply is a sequence of VALUEs, the final one empty
+  # answered from the local url index when it knows of the key,
+  # otherwise reply is a sequence of VALUEs, the final one empty
   def GETURLS(self, key, prefix=""):
+    if self.urlIndex():
+      urls = self.url_index.urls(key, prefix)
+      if len(urls):
+        return urls
     reply = GitAnnexESRP.MessageReply(VALUE=1)
     reply.setRepeatUntilEmpty()
     return self.getReply(reply, 'GETURLS', key, prefix)
 
+  # not actually a git-annex command
+  # returns the index of urls shared with other gitlake remotes,
+  # or False if it could not be opened
+  def urlIndex(self):
+    with self.url_index_lock:
+      if self.url_index is None:
+        try:
+          # imported here: the url index is python 3 only, and this module is not
+          from gitlake.url_index import UrlIndex
+          self.url_index = UrlIndex(self.gitDir())
+        except Exception:
+          self.exception(False)
+          self.url_index = False
+    return self.url_index
+
+  # not actually a git-annex command
+  # returns the cache of chunk digests and where they are stored,
+  # or False if it could not be opened
+  def dedupCache(self):
+    with self.dedup_cache_lock:
+      if self.dedup_cache is None:
+        try:
+          from gitlake.dedup_cache import DedupCache
+          self.dedup_cache = DedupCache(self.gitDir())
+        except Exception:
+          self.exception(False)
+          self.dedup_cache = False
+    return self.dedup_cache
+
+  # not actually a git-annex command
+  # GETGITDIR, only asked once
+  def gitDir(self):
+    if self.git_dir is None:
+      self.git_dir = self.GETGITDIR()
+    return self.git_dir
+
+  # not actually a git-annex command
+  # GETUUID, only asked once
+  def remoteUuid(self):
+    if self.uuid is None:
+      self.uuid = self.GETUUID()
+    return self.uuid
+
   # not actually a git-annex command
   # returns the size of the content of the key
   def GETSIZE(self, key):
@@ -317,7 +474,16 @@ class GitAnnexESRP(threading.Thread):
     return self.send('PREPARE-SUCCESS')
 
   def onEXTENSIONS(self, *extensions):
-    self.extensions = set(extensions) & set(('INFO',))
+    supported = set(('INFO',))
+    if self.async_workers > 0:
+      supported.add('ASYNC')
+    self.extensions = set(extensions) & supported
+    if 'ASYNC' in self.extensions and not self.workers:
+      for idx in range(self.async_workers):
+        worker = threading.Thread(target = self.work)
+        worker.daemon = True
+        worker.start()
+        self.workers.append(worker)
     return self.send('EXTENSIONS', *self.extensions)
 
   # store/retrieve a key, commands may be sent during transfer
@@ -339,29 +505,75 @@ class GitAnnexESRP(threading.Thread):
   def _store_deduplicate(self, key, file):
     if key.find('-s') != -1 and key.find('-S') != -1:
       # file is a chunk: deduplicate
+      from gitlake.chunk_stream import ChunkStream
       backend, hashobj = 'BLAKE2B512', hashlib.blake2b(digest_size=512//8)
-      with open(file, 'rb') as f:
-        for chunk in iter(lambda: f.read(1024*1024), b''):
-                hashobj.update(chunk)
-      subkey = '{}-s{}--{}'.format(backend, self.GETSIZE(key), hashobj.hexdigest())
-      if self.isPresent(subkey):
-        for url in self.GETURLS(subkey):
-          if self.claimsUrl(url):
-            if url.startswith('http') or url.startswith('ftp'):
-              self.SETURLPRESENT(key, url)
-            else:
-              self.SETURIPRESENT(key, url)
+      cache = self.dedupCache()
+      digest = cache.digest(file) if cache else None
+      if digest is None:
+        # not hashed before, so not known to be stored: hash it in the same pass that uploads it, if the backend can
+        try:
+          with ChunkStream(file, hashobj) as stream:
+            self.storeStream(key, file, stream)
+            digest = stream.hexdigest()
+        except NotImplementedError:
+          pass
+        else:
+          if cache:
+            cache.set_digest(file, digest)
+          self._recordSubkey(key, '{}-s{}--{}'.format(backend, self.GETSIZE(key), digest), digest)
+          return
+        if cache:
+          digest = cache.file_digest(file, hashobj)
+        else:
+          with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024*1024), b''):
+              hashobj.update(chunk)
+          digest = hashobj.hexdigest()
+      subkey = '{}-s{}--{}'.format(backend, self.GETSIZE(key), digest)
+      # urls already recorded for this content skip the presence probe,
+      # removing a key from this remote forgets them
+      urls = cache.urls(self.remoteUuid(), digest) if cache else []
+      if len(urls) or self.isPresent(subkey):
+        if not len(urls):
+          urls = [url for url in self.GETURLS(subkey) if self.claimsUrl(url)]
+          if cache:
+            cache.add_urls(self.remoteUuid(), digest, urls)
+        self._setUrlsPresent(key, urls)
         return
       self.store(key, file)
-      for url in self.GETURLS(key):
-        if self.claimsUrl(url):
-          if url.startswith('http') or url.startswith('ftp'):
-            self.SETURLPRESENT(subkey, url)
-          else:
-            self.SETURIPRESENT(subkey, url)
+      self._recordSubkey(key, subkey, digest)
     else:
       self.store(key, file)
 
+  # after storing key, record where its content is under subkey
+  def _recordSubkey(self, key, subkey, digest):
+    urls = [url for url in self.GETURLS(key) if self.claimsUrl(url)]
+    self._setUrlsPresent(subkey, urls)
+    cache = self.dedupCache()
+    if cache:
+      cache.add_urls(self.remoteUuid(), digest, urls)
+
+  # digests of content the dedup cache records key as stored at,
+  # to be forgotten when key is removed
+  def _dedupDigests(self, key):
+    cache = self.dedupCache()
+    if not cache:
+      return []
+    digests = set()
+    if key.startswith('BLAKE2B512-'):
+      digests.add(key.split('--', 1)[-1])
+    if key.find('-s') != -1 and key.find('-S') != -1:
+      urls = [url for url in self.GETURLS(key) if self.claimsUrl(url)]
+      digests.update(cache.url_digests(self.remoteUuid(), urls))
+    return digests
+
+  def _setUrlsPresent(self, key, urls):
+    for url in urls:
+      if url.startswith('http') or url.startswith('ftp'):
+        self.SETURLPRESENT(key, url)
+      else:
+        self.SETURIPRESENT(key, url)
+
   # request to check if key is present
   # reply CHECKPRESENT-SUCCESS <key>, CHECKPRESENT-FAILURE <key>,
   # or CHECKPRESENT-UNKNOWN <key> <message>
@@ -379,7 +591,10 @@ class GitAnnexESRP(threading.Thread):
   # reply REMOVE-SUCCESS <key> or REMOVE-FAILURE <key> <message>
   def onREMOVE(self, key):
     try:
+      digests = self._dedupDigests(key)
       self.remove(key)
+      for digest in digests:
+        self.dedupCache().forget_urls(self.remoteUuid(), digest)
     except Exception as e:
       self.exception(False)
       return self.send('REMOVE-FAILURE', key, *(str(arg) for arg in e.args))
@@ -460,6 +675,11 @@ class GitAnnexESRP(threading.Thread):
   def store(self, key, file):
     raise NotImplementedError("store not implemented")
 
+  # optional: store file in key, uploading the content read from stream,
+  # a ChunkStream that hashes it for deduplication as it is consumed
+  def storeStream(self, key, file, stream):
+    raise NotImplementedError("storeStream not implemented")
+
   # retrieve key to file
   def retrieve(self, key, file):
     raise NotImplementedError("retrieve not implemented")
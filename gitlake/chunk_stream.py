@@ -0,0 +1,85 @@
+import mmap, os, threading
+
+class ChunkStream:
+    '''A memory-mapped read of a file that feeds a hash object as the content is consumed.
+    An uploader iterates or read()s it, and the digest is complete when it finishes,
+    so the file only crosses the disk once. Rewinding for another upload does not rehash.
+    reader() gives independent passes for uploading to several places at once. hashobj may be None.
+    '''
+
+    def __init__(self, path, hashobj, blocksize = 1024 * 1024):
+        self.path = path
+        self.hashobj = hashobj
+        self.blocksize = blocksize
+        self.offset = 0
+        self.hashed = 0
+        self.hash_lock = threading.Lock()
+        self.file = None
+        self.map = None
+
+    def __enter__(self):
+        self.file = open(self.path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        if self.size:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                self.map.madvise(mmap.MADV_SEQUENTIAL)
+        else:
+            self.map = b''
+        return self
+
+    def __exit__(self, *params):
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+        self.file.close()
+
+    def __len__(self):
+        return self.size
+
+    def __str__(self):
+        return self.path
+
+    def __iter__(self):
+        while True:
+            data = self.read(self.blocksize)
+            if not len(data):
+                break
+            yield data
+
+    def read(self, size = -1):
+        if size is None or size < 0:
+            size = self.size - self.offset
+        data = self.map[self.offset:self.offset + size]
+        self._hash(self.offset, data)
+        self.offset += len(data)
+        return data
+
+    def reader(self):
+        '''Iterate the content from the start, independently of read() and other readers, feeding the same hash.'''
+        offset = 0
+        while offset < self.size:
+            data = self.map[offset:offset + self.blocksize]
+            self._hash(offset, data)
+            offset += len(data)
+            yield data
+
+    def tell(self):
+        return self.offset
+
+    def rewind(self):
+        self.offset = 0
+
+    def _hash(self, offset, data):
+        # only content past what is already hashed, so rereads are not counted twice
+        if self.hashobj is None:
+            return
+        with self.hash_lock:
+            if offset <= self.hashed < offset + len(data):
+                self.hashobj.update(data[self.hashed - offset:])
+                self.hashed = offset + len(data)
+
+    def hexdigest(self):
+        '''Digest of the whole file, hashing whatever the uploader did not read.'''
+        while self.hashed < self.size:
+            self._hash(self.hashed, self.map[self.hashed:self.hashed + self.blocksize])
+        return self.hashobj.hexdigest()
@@ -0,0 +1,119 @@
+import contextlib, resource, threading, time
+
+import requests
+
+class FileHandleBudget:
+    '''A process-wide count of file handles held by requests in flight, kept under RLIMIT_NOFILE.
+    reserve handles are left for everything else the process opens.'''
+
+    def __init__(self, reserve = 64):
+        try:
+            limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+        except ValueError:
+            limit = 1024
+        if limit == resource.RLIM_INFINITY:
+            limit = 1 << 16
+        self.limit = max(1, limit - reserve)
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.used >= self.limit:
+                self.condition.wait()
+            self.used += 1
+
+    def release(self):
+        with self.condition:
+            self.used -= 1
+            self.condition.notify()
+
+file_handles = FileHandleBudget()
+
+def throttled(exc):
+    '''Whether exc means the endpoint is overloaded: 429, 5xx, or a failed or timed out connection.'''
+    response = getattr(exc, 'response', None)
+    status = getattr(response, 'status_code', None)
+    if status is None and len(exc.args) > 1 and type(exc.args[1]) is int:
+        # ar.ArweaveNetworkException(text, status, exception, response)
+        status = exc.args[1]
+    if status:
+        return status == 429 or status >= 500
+    return isinstance(exc, (requests.ConnectionError, requests.Timeout, ConnectionError, TimeoutError))
+
+class AdaptiveConcurrency:
+    '''An AIMD limit on the requests in flight to one endpoint.
+    Each window of successful requests grows the limit by one while latency stays near
+    the fastest seen, and a throttled request halves it, at most once per round trip.
+    Every request in flight also holds a handle from the process-wide file_handles budget.
+    '''
+
+    def __init__(self, name, initial = 4, minimum = 1, maximum = 64, budget = file_handles):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.budget = budget
+        self.in_flight = 0
+        self.latency = None
+        self.base_latency = None
+        self.successes = 0
+        self.throttles = 0
+        self.last_decrease = 0
+        self.condition = threading.Condition()
+
+    def __str__(self):
+        latency = 'unknown' if self.latency is None else f'{self.latency:.3f}s'
+        return f'{self.name}: {self.in_flight}/{int(self.limit)} in flight, {latency} latency, {self.successes} succeeded, {self.throttles} throttled'
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+        self.budget.acquire()
+
+    def release(self, latency, throttled = False):
+        self.budget.release()
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.decrease()
+            else:
+                self.successes += 1
+                self.latency = latency if self.latency is None else self.latency * 0.9 + latency * 0.1
+                # let the baseline drift up so one lucky request does not pin it
+                self.base_latency = latency if self.base_latency is None else min(self.base_latency * 1.001, latency)
+                if self.latency <= self.base_latency * 2 and self.limit < self.maximum:
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def decrease(self):
+        '''Halve the limit, as when the endpoint reports it is throttling us.'''
+        with self.condition:
+            self.throttles += 1
+            now = time.monotonic()
+            if now - self.last_decrease >= (self.latency or 0):
+                self.limit = max(self.minimum, self.limit / 2)
+                self.last_decrease = now
+
+    @contextlib.contextmanager
+    def slot(self):
+        '''Hold a request slot for the duration of the block, classifying any exception it raises.'''
+        self.acquire()
+        start = time.monotonic()
+        try:
+            yield
+        except BaseException as exc:
+            self.release(time.monotonic() - start, throttled(exc))
+            raise
+        else:
+            self.release(time.monotonic() - start)
+
+    def call(self, func, *params, **kwparams):
+        with self.slot():
+            return func(*params, **kwparams)
+
+    def map(self, executor, func, iterable):
+        '''executor.map(func, iterable), with calls held to the limit. executor should have maximum workers.'''
+        return executor.map(lambda item: self.call(func, item), iterable)
@@ -0,0 +1,94 @@
+import os, sqlite3, threading, time
+
+class DedupCache:
+    '''A persistent cache for chunk deduplication.
+    Maps a file's (path, device, inode, size, mtime) to its content digest, so unchanged files are not rehashed,
+    and maps a digest to the urls a remote is known to hold it at, so presence need not be probed again.
+    Least recently used entries are evicted once a table holds more than max_entries rows.
+    '''
+
+    def __init__(self, git_dir, max_entries = 1 << 20):
+        self.max_entries = max_entries
+        self.lock = threading.RLock()
+        self.inserts = 0
+        path = os.path.join(git_dir, 'gitlake')
+        os.makedirs(path, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(path, 'dedup.sqlite3'), timeout=60, check_same_thread=False)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS digests (path TEXT, device INTEGER, inode INTEGER, size INTEGER, mtime INTEGER, digest TEXT, last_used REAL, PRIMARY KEY (path, device, inode, size, mtime))')
+            self.db.execute('CREATE TABLE IF NOT EXISTS urls (remote TEXT, digest TEXT, url TEXT, last_used REAL, PRIMARY KEY (remote, digest, url))')
+            self.db.execute('CREATE INDEX IF NOT EXISTS digests_last_used ON digests (last_used)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS urls_last_used ON urls (last_used)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS urls_url ON urls (remote, url)')
+
+    @staticmethod
+    def _stat_id(path):
+        st = os.stat(path)
+        return (os.path.abspath(path), st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def digest(self, path):
+        '''The cached digest of the file at path, or None if it changed or was never hashed.'''
+        stat_id = self._stat_id(path)
+        with self.lock, self.db:
+            row = self.db.execute('SELECT digest FROM digests WHERE path = ? AND device = ? AND inode = ? AND size = ? AND mtime = ?', stat_id).fetchone()
+            if row is None:
+                return None
+            self.db.execute('UPDATE digests SET last_used = ? WHERE path = ? AND device = ? AND inode = ? AND size = ? AND mtime = ?', (time.time(), *stat_id))
+        return row[0]
+
+    def set_digest(self, path, digest, stat_id = None):
+        '''Record the digest of the file at path. Pass stat_id from before hashing to avoid caching a racing write.'''
+        if stat_id is None:
+            stat_id = self._stat_id(path)
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?)', (*stat_id, digest, time.time()))
+            self._evict()
+
+    def file_digest(self, path, hashobj, blocksize = 1024 * 1024):
+        '''Digest of the file at path, hashing it with hashobj only if it is not cached.'''
+        digest = self.digest(path)
+        if digest is None:
+            stat_id = self._stat_id(path)
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(blocksize), b''):
+                    hashobj.update(chunk)
+            digest = hashobj.hexdigest()
+            self.set_digest(path, digest, stat_id)
+        return digest
+
+    def urls(self, remote, digest):
+        '''Urls remote is known to hold content with digest at.'''
+        with self.lock, self.db:
+            rows = self.db.execute('SELECT url FROM urls WHERE remote = ? AND digest = ?', (remote, digest)).fetchall()
+            if rows:
+                self.db.execute('UPDATE urls SET last_used = ? WHERE remote = ? AND digest = ?', (time.time(), remote, digest))
+        return [url for url, in rows]
+
+    def add_urls(self, remote, digest, urls):
+        with self.lock, self.db:
+            now = time.time()
+            for url in urls:
+                self.db.execute('INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?)', (remote, digest, url, now))
+            self._evict()
+
+    def url_digests(self, remote, urls):
+        '''Digests of the content remote is known to hold at any of urls.'''
+        digests = set()
+        with self.lock:
+            for url in urls:
+                digests.update(digest for digest, in self.db.execute('SELECT digest FROM urls WHERE remote = ? AND url = ?', (remote, url)))
+        return digests
+
+    def forget_urls(self, remote, digest):
+        '''Drop what is known about remote holding digest, such as when its content was found missing.'''
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM urls WHERE remote = ? AND digest = ?', (remote, digest))
+
+    def _evict(self):
+        self.inserts += 1
+        if self.inserts % 1024:
+            return
+        for table in ('digests', 'urls'):
+            count = self.db.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+            if count > self.max_entries:
+                self.db.execute(f'DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} ORDER BY last_used LIMIT ?)', (count - self.max_entries,))
@@ -1,5 +1,5 @@
 import git
-import configparser, hashlib, re, sys, os, shutil, subprocess
+import configparser, hashlib, json, re, sys, os, shutil, subprocess
 
 import logging
 logging.basicConfig(level=logging.DEBUG)
@@ -8,8 +8,12 @@ logging.basicConfig(level=logging.DEBUG)
 class GitRemoteSubprocess:
     '''A gitremote-helpers remote that uses a shadow directory and launches git-receive-pack and git-upload-pack subprocesses.
     This lets anything that can upload and download a folder be a git remote, by implementing the upload() and download() methods.
+    Subclasses whose upload() adds to what is already stored, rather than replacing it, can set incremental = True
+    so that each push after the first uploads only the new packs and the updated refs.
     '''
 
+    incremental = False
+
     def __init__(self, git_dir = '.', url = None, remote_name = None, protocol = None):
         self.DISTINGUISHING_FILENAME = f'git-remote-{protocol}'
         self.DISTINGUISHING_TEXT = f'This is a {self.DISTINGUISHING_FILENAME} repository.'
@@ -26,6 +30,7 @@ class GitRemoteSubprocess:
         self.local = self.path2repo(git_dir)
         self.shadow_gitdir = os.path.join(self.local.git_dir, self.__class__.__name__, self.id())
         self.shadow_gitdir_tmp = os.path.join(self.local.git_dir, self.__class__.__name__, 'git.new')
+        self.uploaded_path = os.path.join(self.local.git_dir, self.__class__.__name__, self.id() + '.uploaded.json')
 
         try:
             self.remote_shadow = git.Repo(self.shadow_gitdir)
@@ -114,9 +119,15 @@ class GitRemoteSubprocess:
     def id(self):
         return hashlib.blake2b(self.fetch_url.encode(), digest_size=32).hexdigest()
 
-    def download(self, gitdir):
+    def download(self, gitdir, manifest):
         '''Download or sync to gitdir any available files and paths among:
            config HEAD packed-refs objects/ info/ refs/
+           gitdir persists between calls, and manifest describes what it already holds:
+             packs: names (pack-<hash>) of the packs present under objects/pack/
+             refs: a dict of loose ref path (refs/...) to its content
+             packed_refs: the content of packed-refs, or ''
+             head: the content of HEAD, or ''
+           Only missing packs and changed refs need be fetched. Packs are immutable, so one present is current.
         '''
         raise NotImplementedError()
 
@@ -125,12 +136,14 @@ class GitRemoteSubprocess:
            Loose objects will have been removed.
            The most important paths are:
            HEAD packed-refs objects/ info/ refs/ 
+           If incremental is set, after the first upload gitdir holds only the new packs under objects/pack/
+           and the replaced HEAD packed-refs info/refs objects/info/packs, all refs being in packed-refs.
         '''
         raise NotImplementedError()
     
     def _download(self):
         os.makedirs(self.shadow_gitdir, exist_ok=True)
-        self.download(self.shadow_gitdir)
+        self.download(self.shadow_gitdir, self._manifest())
         os.makedirs(os.path.join(self.shadow_gitdir, 'refs'), exist_ok=True)
         try:
             self.remote_shadow = git.Repo(self.shadow_gitdir)
@@ -140,30 +153,22 @@ class GitRemoteSubprocess:
             raise
 
     def _upload(self):
+        uploaded = self._uploaded()
+        if self.incremental and uploaded is not None:
+            return self._upload_incremental(uploaded)
         # mirror_path_new is self.shadow_gitdir_tmp
         # mirror_path is self.shadow_gitdir
-        if os.path.exists(self.shadow_gitdir_tmp):
-            if os.path.isdir(self.shadow_gitdir_tmp) and not os.path.islink(self.shadow_gitdir_tmp):
-                shutil.rmtree(self.shadow_gitdir_tmp)
-            else:
-                os.unlink(self.shadow_gitdir_tmp)
+        self._clear_tmp()
         cleanrepo = git.Repo.clone_from(self.shadow_gitdir, self.shadow_gitdir_tmp, multi_options = ['--mirror', '--bare']) 
         cleanrepo.config_writer().set_value('gc', 'auto', 0).release()
         cleanrepo.git.pack_objects('objects/pack/pack', all=True, include_tag=True, unpacked=True, incremental=True, non_empty=True, local=True, compression=9, delta_base_offset=True, pack_loose_unreachable=True, progress=True, istream=subprocess.DEVNULL)
         cleanrepo.git.prune_packed()
 
-        # each first commit is the head of a commit tree that identifies forks of the same codebase.
-        # this tags each first commit for systems that can find files by content, to find forks via small ref files
-        first_commits = cleanrepo.git.rev_list('HEAD', max_parents=0).split('\n')
-        tag_name = self.fetch_url.replace(':', '/')
-        while '//' in tag_name:
-            tag_name = tag_name.replace('//', '/')
-        for idx, first_commit in enumerate(first_commits):
-            cleanrepo.git.tag(tag_name + '/' + first_commit, first_commit)
+        self._tag_first_commits(cleanrepo)
 
         cleanrepo.git.update_server_info() # generates files needed for cloning and pulling via http, for systems with dirtree gateways
 
-        with open(os.path.join(self.shadow_gitdir_tmp, self.DISTINGUISHING_FILENAME)) as distinguishing_file:
+        with open(os.path.join(self.shadow_gitdir_tmp, self.DISTINGUISHING_FILENAME), 'wt') as distinguishing_file:
             distinguishing_file.write(self.DISTINGUISHING_TEXT)
 
         # code went here to write out a 'description' file, but it seemed important to make the repository description information
@@ -173,6 +178,110 @@ class GitRemoteSubprocess:
 
         shutil.rmtree(self.shadow_gitdir)
         os.rename(self.shadow_gitdir_tmp, self.shadow_gitdir)
+        self.remote_shadow = git.Repo(self.shadow_gitdir)
+        self._set_uploaded()
+
+    def _upload_incremental(self, uploaded):
+        shadow = self.remote_shadow
+        # only objects received since the last push are loose
+        shadow.git.pack_objects('objects/pack/pack', all=True, include_tag=True, unpacked=True, incremental=True, non_empty=True, local=True, compression=9, delta_base_offset=True, progress=True, istream=subprocess.DEVNULL)
+        shadow.git.prune_packed()
+        self._tag_first_commits(shadow)
+        new_packs = [pack for pack in self._packs() if pack not in uploaded['packs']]
+        if not new_packs and self._refs() == uploaded['refs']:
+            return
+
+        shadow.git.pack_refs(all=True)
+        shadow.git.update_server_info()
+
+        self._clear_tmp()
+        pack_dir = os.path.join('objects', 'pack')
+        os.makedirs(os.path.join(self.shadow_gitdir_tmp, pack_dir))
+        os.makedirs(os.path.join(self.shadow_gitdir_tmp, 'objects', 'info'))
+        os.makedirs(os.path.join(self.shadow_gitdir_tmp, 'info'))
+        for pack in new_packs:
+            for ext in ('.pack', '.idx', '.rev', '.bitmap'):
+                path = os.path.join(pack_dir, pack + ext)
+                if os.path.exists(os.path.join(self.shadow_gitdir, path)):
+                    # packs are immutable, so a hardlink is as good as a copy
+                    try:
+                        os.link(os.path.join(self.shadow_gitdir, path), os.path.join(self.shadow_gitdir_tmp, path))
+                    except OSError:
+                        shutil.copyfile(os.path.join(self.shadow_gitdir, path), os.path.join(self.shadow_gitdir_tmp, path))
+        for path in ('HEAD', 'packed-refs', os.path.join('info', 'refs'), os.path.join('objects', 'info', 'packs')):
+            if os.path.exists(os.path.join(self.shadow_gitdir, path)):
+                shutil.copyfile(os.path.join(self.shadow_gitdir, path), os.path.join(self.shadow_gitdir_tmp, path))
+        with open(os.path.join(self.shadow_gitdir_tmp, self.DISTINGUISHING_FILENAME), 'wt') as distinguishing_file:
+            distinguishing_file.write(self.DISTINGUISHING_TEXT)
+
+        self.upload(self.shadow_gitdir_tmp)
+
+        shutil.rmtree(self.shadow_gitdir_tmp)
+        self._set_uploaded()
+
+    def _clear_tmp(self):
+        if os.path.exists(self.shadow_gitdir_tmp):
+            if os.path.isdir(self.shadow_gitdir_tmp) and not os.path.islink(self.shadow_gitdir_tmp):
+                shutil.rmtree(self.shadow_gitdir_tmp)
+            else:
+                os.unlink(self.shadow_gitdir_tmp)
+
+    def _tag_first_commits(self, repo):
+        # each first commit is the head of a commit tree that identifies forks of the same codebase.
+        # this tags each first commit for systems that can find files by content, to find forks via small ref files
+        first_commits = repo.git.rev_list('HEAD', max_parents=0).split('\n')
+        tag_name = self.fetch_url.replace(':', '/')
+        while '//' in tag_name:
+            tag_name = tag_name.replace('//', '/')
+        tags = set(repo.git.tag('-l', tag_name + '/*').split('\n'))
+        for idx, first_commit in enumerate(first_commits):
+            if tag_name + '/' + first_commit not in tags:
+                repo.git.tag(tag_name + '/' + first_commit, first_commit)
+
+    def _refs(self):
+        refs = {}
+        for line in self.remote_shadow.git.for_each_ref(format='%(objectname) %(refname)').split('\n'):
+            if line:
+                objectname, refname = line.split(' ', 1)
+                refs[refname] = objectname
+        return refs
+
+    def _packs(self):
+        pack_dir = os.path.join(self.shadow_gitdir, 'objects', 'pack')
+        if not os.path.isdir(pack_dir):
+            return []
+        # a pack is only complete once its index is written
+        return sorted((name[:-len('.pack')] for name in os.listdir(pack_dir) if name.endswith('.pack') and os.path.exists(os.path.join(pack_dir, name[:-len('.pack')] + '.idx'))))
+
+    def _manifest(self):
+        '''what the shadow directory holds, passed to download()'''
+        refs = {}
+        for subpath, subdirs, subfiles in os.walk(os.path.join(self.shadow_gitdir, 'refs')):
+            for subfile in subfiles:
+                path = os.path.join(subpath, subfile)
+                with open(path, 'rt') as ref_file:
+                    refs[os.path.relpath(path, self.shadow_gitdir).replace(os.sep, '/')] = ref_file.read()
+        contents = {}
+        for name in ('packed-refs', 'HEAD'):
+            try:
+                with open(os.path.join(self.shadow_gitdir, name), 'rt') as content_file:
+                    contents[name] = content_file.read()
+            except FileNotFoundError:
+                contents[name] = ''
+        return dict(packs = self._packs(), refs = refs, packed_refs = contents['packed-refs'], head = contents['HEAD'])
+
+    def _uploaded(self):
+        '''the packs and refs of the shadow directory as of its last upload, or None if never uploaded'''
+        try:
+            with open(self.uploaded_path, 'rt') as uploaded_file:
+                return json.load(uploaded_file)
+        except FileNotFoundError:
+            return None
+
+    def _set_uploaded(self):
+        with open(self.uploaded_path + '.tmp', 'wt') as uploaded_file:
+            json.dump(dict(packs = self._packs(), refs = self._refs()), uploaded_file)
+        os.rename(self.uploaded_path + '.tmp', self.uploaded_path)
 
     def url2fetchpush(self, url):
         '''can override to generate two different urls for push access. both are stored in local config.'''
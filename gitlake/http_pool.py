@@ -0,0 +1,69 @@
+import threading, urllib.parse
+
+import requests
+
+class HTTPPool:
+    '''Keep-alive HTTP connections shared by everything a remote requests.
+    Each host gets its own requests.Session holding at most connections_per_host
+    connections, or the host's entry in limits, so repeated requests to a gateway
+    or portal reuse a connection instead of handshaking again.
+    Requests past the limit wait for a connection to be returned.
+    '''
+
+    def __init__(self, connections_per_host = 16, limits = {}, retries = 5):
+        self.connections_per_host = connections_per_host
+        self.limits = dict(limits)
+        self.retries = retries
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def host(url):
+        parts = urllib.parse.urlsplit(url)
+        return parts.scheme + '://' + parts.netloc
+
+    def session(self, url):
+        '''The session for url's host, created the first time the host is seen.'''
+        host = self.host(url)
+        with self.lock:
+            session = self.sessions.get(host)
+            if session is None:
+                limit = self.limits.get(host, self.connections_per_host)
+                max_retries = requests.adapters.Retry(total=self.retries, backoff_factor=0.1)
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=limit, max_retries=max_retries, pool_block=True)
+                session = requests.Session()
+                session.mount(host, adapter)
+                self.sessions[host] = session
+        return session
+
+    def adopt(self, client):
+        '''Point a pyarweave client, such as an ar.Peer or bundlr.Node, at the session for its api_url.'''
+        if client.session is not self.session(client.api_url):
+            client.session.close()
+            client.session = self.session(client.api_url)
+        return client
+
+    def request(self, method, url, **kwparams):
+        while True:
+            try:
+                return self.session(url).request(method, url, **kwparams)
+            except requests.ConnectionError as exc:
+                # retries ClosedPoolError https://github.com/urllib3/urllib3/issues/951
+                if len(exc.args) > 0 and type(exc.args[0]) is requests.urllib3.exceptions.ClosedPoolError:
+                    continue
+                raise
+
+    def get(self, url, **kwparams):
+        return self.request('GET', url, **kwparams)
+
+    def head(self, url, **kwparams):
+        return self.request('HEAD', url, **kwparams)
+
+    def post(self, url, **kwparams):
+        return self.request('POST', url, **kwparams)
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
@@ -0,0 +1,118 @@
+import collections, concurrent.futures, json, os, threading, time
+
+from gitlake.concurrency import throttled
+
+class Scoreboard:
+    '''Persistent latency and error statistics for interchangeable endpoints, such as gateways serving the same data.
+    Endpoints are ranked by smoothed latency, inflated by their recent error rate. hedge() sends a request to the
+    best ranked endpoint and starts it on the next whenever the last started has run past its tail latency or failed.
+    '''
+
+    def __init__(self, path, window = 128, tail = 0.95, default_latency = 1.0, save_every = 64):
+        self.path = path
+        self.window = window
+        self.tail = tail
+        self.default_latency = default_latency
+        self.save_every = save_every
+        self.lock = threading.Lock()
+        self.changes = 0
+        self.stats = {}
+        try:
+            with open(path, 'rt') as file:
+                for name, stats in json.load(file).items():
+                    self._stats(name).update(latency = stats['latency'], error_rate = stats['error_rate'])
+                    self._stats(name)['samples'].extend(stats['samples'])
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+
+    def _stats(self, name):
+        if name not in self.stats:
+            self.stats[name] = dict(latency = None, error_rate = 0.0, samples = collections.deque(maxlen = self.window))
+        return self.stats[name]
+
+    def record(self, name, latency, error = False):
+        with self.lock:
+            stats = self._stats(name)
+            stats['error_rate'] = stats['error_rate'] * 0.9 + (0.1 if error else 0)
+            if not error:
+                stats['latency'] = latency if stats['latency'] is None else stats['latency'] * 0.9 + latency * 0.1
+                stats['samples'].append(latency)
+            self.changes += 1
+            if self.changes >= self.save_every:
+                self._save()
+
+    def score(self, name):
+        '''Lower is better: expected latency, made worse by errors. Unmeasured endpoints get default_latency.'''
+        with self.lock:
+            stats = self._stats(name)
+            latency = self.default_latency if stats['latency'] is None else stats['latency']
+            return latency * (1 + 10 * stats['error_rate'])
+
+    def tail_latency(self, name):
+        '''The tail quantile of name's recent latencies, after which a request to it is hedged.'''
+        with self.lock:
+            samples = sorted(self._stats(name)['samples'])
+        if not samples:
+            return self.default_latency * 2
+        return samples[min(len(samples) - 1, int(len(samples) * self.tail))]
+
+    def ranked(self, endpoints, name = str):
+        '''endpoints, best first. Ties keep their order.'''
+        return sorted(endpoints, key = lambda endpoint: self.score(name(endpoint)))
+
+    def hedge(self, executor, func, endpoints, name = str, discard = None):
+        '''Return func(endpoint) from whichever endpoint answers first, starting with the best ranked
+        and adding the next one each time the last started passes its tail latency or fails.
+        discard is called with the results of the others that still succeed, to release them.
+        Raises the last exception if all of them fail.'''
+        def timed(endpoint):
+            start = time.monotonic()
+            try:
+                result = func(endpoint)
+            except Exception as exc:
+                self.record(name(endpoint), time.monotonic() - start, throttled(exc))
+                raise
+            self.record(name(endpoint), time.monotonic() - start)
+            return result
+        endpoints = self.ranked(endpoints, name)
+        if len(endpoints) == 1:
+            return timed(endpoints[0])
+        pending = {}
+        last_exc = None
+        start_next = True
+        while True:
+            if start_next and endpoints:
+                endpoint = endpoints.pop(0)
+                pending[executor.submit(timed, endpoint)] = endpoint
+                deadline = time.monotonic() + self.tail_latency(name(endpoint))
+            if not pending:
+                raise last_exc
+            timeout = max(0, deadline - time.monotonic()) if endpoints else None
+            done, _ = concurrent.futures.wait(pending, timeout = timeout, return_when = concurrent.futures.FIRST_COMPLETED)
+            start_next = not done
+            for future in done:
+                del pending[future]
+                try:
+                    result = future.result()
+                except Exception as exc:
+                    last_exc = exc
+                    start_next = True
+                    continue
+                for other in pending:
+                    if not other.cancel() and discard is not None:
+                        other.add_done_callback(lambda other: other.exception() is None and discard(other.result()))
+                return result
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        self.changes = 0
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wt') as file:
+            json.dump({
+                name: dict(latency = stats['latency'], error_rate = stats['error_rate'], samples = list(stats['samples']))
+                for name, stats in self.stats.items()
+            }, file)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,99 @@
+import os, sqlite3, threading, time
+
+class TransactionJournal:
+    '''A persistent record of transactions a remote broadcast or checked, so their state need not be polled one by one.
+    Signed transactions are kept until they are confirmed, to be rebroadcast if the network drops them.
+    The block height each transaction was mined at is cached, so confirmations follow from the chain height alone.
+    The part txids of linker transactions, which never change, are cached too.
+    '''
+
+    def __init__(self, path):
+        self.lock = threading.RLock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.db:
+            # height is NULL until mined. seen is when the network last reported holding the transaction.
+            self.db.execute('CREATE TABLE IF NOT EXISTS txs (txid TEXT PRIMARY KEY, key TEXT, rawtx TEXT, height INTEGER, seen REAL, broadcast REAL)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS parts (linker TEXT PRIMARY KEY, txids TEXT)')
+
+    def add(self, key, txs):
+        '''Record the signed transactions txs, a dict of txid to raw hex, as broadcast for key now.'''
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany(
+                'INSERT INTO txs VALUES (?, ?, ?, NULL, NULL, ?) ON CONFLICT (txid) DO UPDATE SET key = excluded.key, rawtx = excluded.rawtx, broadcast = excluded.broadcast',
+                ((txid, key, rawtx, now) for txid, rawtx in txs.items())
+            )
+
+    def rawtx(self, txid):
+        '''The signed transaction txid if it is still held for rebroadcasting, otherwise None.'''
+        with self.lock:
+            row = self.db.execute('SELECT rawtx FROM txs WHERE txid = ?', (txid,)).fetchone()
+        return row and row[0]
+
+    def rebroadcast(self, txid):
+        with self.lock, self.db:
+            self.db.execute('UPDATE txs SET broadcast = ? WHERE txid = ?', (time.time(), txid))
+
+    def heights(self, txids):
+        '''A dict mapping those of txids the network was seen to hold to the height they were mined at, or None if unmined.'''
+        txids = list(txids)
+        result = {}
+        with self.lock:
+            # sqlite limits the number of parameters in one statement
+            for offset in range(0, len(txids), 512):
+                batch = txids[offset:offset+512]
+                result.update(self.db.execute(
+                    f'SELECT txid, height FROM txs WHERE seen IS NOT NULL AND txid IN ({",".join("?" * len(batch))})',
+                    batch
+                ).fetchall())
+        return result
+
+    def update(self, heights, missing = ()):
+        '''Record the network as holding heights, a dict of txid to mined height or None, and as not holding missing.'''
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany(
+                'INSERT INTO txs VALUES (?, NULL, NULL, ?, ?, NULL) ON CONFLICT (txid) DO UPDATE SET height = excluded.height, seen = excluded.seen',
+                ((txid, height, now) for txid, height in heights.items())
+            )
+            self.db.executemany('UPDATE txs SET height = NULL, seen = NULL WHERE txid = ?', ((txid,) for txid in missing))
+
+    def settle(self, txids):
+        '''Drop the signed copies of txids once they are buried deep enough not to need rebroadcasting.'''
+        with self.lock, self.db:
+            self.db.executemany('UPDATE txs SET rawtx = NULL WHERE txid = ?', ((txid,) for txid in txids))
+
+    def pending(self):
+        '''A dict mapping each key to the txids still held for rebroadcasting.'''
+        result = {}
+        with self.lock:
+            for key, txid in self.db.execute('SELECT key, txid FROM txs WHERE rawtx IS NOT NULL'):
+                result.setdefault(key, []).append(txid)
+        return result
+
+    def lineage(self, txids):
+        '''txids preceded by the transactions still held for the same keys, in the order they were added,
+        which puts parents before the transactions that spend them.'''
+        txids = list(txids)
+        held = {}
+        with self.lock:
+            # sqlite limits the number of parameters in one statement
+            for offset in range(0, len(txids), 512):
+                batch = txids[offset:offset+512]
+                held.update(self.db.execute(
+                    f'SELECT rowid, txid FROM txs WHERE rawtx IS NOT NULL AND key IN (SELECT key FROM txs WHERE txid IN ({",".join("?" * len(batch))}))',
+                    batch
+                ).fetchall())
+        held = [txid for rowid, txid in sorted(held.items())]
+        return held + [txid for txid in txids if txid not in held]
+
+    def parts(self, linker):
+        '''The part txids of linker, or None if they are not cached.'''
+        with self.lock:
+            row = self.db.execute('SELECT txids FROM parts WHERE linker = ?', (linker,)).fetchone()
+        return row and row[0].split()
+
+    def set_parts(self, linker, txids):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO parts VALUES (?, ?)', (linker, ' '.join(txids)))
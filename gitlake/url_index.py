@@ -0,0 +1,247 @@
+import os, sqlite3, subprocess, threading, time
+
+WEB_LOG_SUFFIX = '.log.web'
+LOCATION_LOG_SUFFIX = '.log'
+
+class UrlIndex:
+    '''A persistent index of the urls and uris git-annex has recorded for each key, and of which repositories hold it.
+    It is built incrementally from the *.log.web and location *.log files on the git-annex branch and in the journal,
+    and written through by this process, so lookups do not need a GETURLS round trip to git-annex.
+    Uris are stored as git-annex logs them, with a leading ':', and returned without it.
+    '''
+
+    def __init__(self, git_dir, refresh_interval = 60):
+        self.git_dir = git_dir
+        self.refresh_interval = refresh_interval
+        self.last_refresh = 0
+        self.lock = threading.RLock()
+        path = os.path.join(git_dir, 'gitlake')
+        os.makedirs(path, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(path, 'urlindex.sqlite3'), timeout=60, check_same_thread=False)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS urls (key TEXT, url TEXT, present INTEGER, timestamp REAL, PRIMARY KEY (key, url))')
+            self.db.execute('CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, value TEXT)')
+            if not self.db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'locations'").fetchone():
+                self.db.execute('CREATE TABLE locations (key TEXT, uuid TEXT, present INTEGER, timestamp REAL, present_timestamp REAL, PRIMARY KEY (key, uuid))')
+                # an index from before locations were tracked must be rebuilt to include them
+                self.db.execute("DELETE FROM state WHERE name IN ('commit', 'journal_mtime')")
+
+    def urls(self, key, prefix = ''):
+        '''Urls and uris known to be present for key that start with prefix, like GETURLS.'''
+        self.refresh()
+        with self.lock:
+            rows = self.db.execute('SELECT url FROM urls WHERE key = ? AND present = 1 ORDER BY timestamp', (key,)).fetchall()
+        urls = [url[1:] if url.startswith(':') else url for url, in rows]
+        return [url for url in urls if url.startswith(prefix)]
+
+    def timestamps(self, key, *urls):
+        '''Map of url to the time of its last change in the log, for those of urls that are logged for key.
+        Uris must be passed with their leading ':'.'''
+        self.refresh()
+        with self.lock:
+            rows = self.db.execute('SELECT url, timestamp FROM urls WHERE key = ?', (key,)).fetchall()
+        return {url: timestamp for url, timestamp in rows if url in urls}
+
+    def location_timestamp(self, key, uuid):
+        '''The time the location log last recorded key as present in the repository with uuid, or None.'''
+        self.refresh()
+        with self.lock:
+            row = self.db.execute('SELECT present_timestamp FROM locations WHERE key = ? AND uuid = ?', (key, uuid)).fetchone()
+        return row[0] if row else None
+
+    def set_present(self, key, url, present = True, uri = False):
+        if uri:
+            url = ':' + url
+        with self.lock, self.db:
+            self._update(key, url, present, time.time())
+
+    def set_missing(self, key, url, uri = False):
+        self.set_present(key, url, False, uri)
+
+    def refresh(self, force = False):
+        '''Index any changes to the git-annex branch and journal since the last refresh.'''
+        now = time.time()
+        if not force and now - self.last_refresh < self.refresh_interval:
+            return
+        with self.lock:
+            self.last_refresh = now
+            commit = self._git('rev-parse', '--verify', '-q', 'refs/heads/git-annex').strip()
+            last_commit = self._state('commit')
+            with self.db:
+                if commit and commit != last_commit:
+                    if last_commit:
+                        changes = []
+                        for line in self._git('diff-tree', '-r', '--no-renames', last_commit, commit).split('\n'):
+                            if '\t' not in line:
+                                continue
+                            info, path = line.split('\t', 1)
+                            changes.append((info.split(' ')[3], path))
+                    else:
+                        changes = []
+                        for line in self._git('ls-tree', '-r', '--full-tree', commit).split('\n'):
+                            if '\t' not in line:
+                                continue
+                            info, path = line.split('\t', 1)
+                            changes.append((info.split(' ')[2], path))
+                    # location logs are in the hash directories, unlike the repository-wide logs at the top
+                    changes = [(sha, path) for sha, path in changes if path.endswith(WEB_LOG_SUFFIX) or ('/' in path and path.endswith(LOCATION_LOG_SUFFIX))]
+                    deleted = [path for sha, path in changes if not sha.strip('0')]
+                    for path in deleted:
+                        table = 'urls' if path.endswith(WEB_LOG_SUFFIX) else 'locations'
+                        self.db.execute(f'DELETE FROM {table} WHERE key = ?', (self.path2key(path),))
+                    changes = [(sha, path) for sha, path in changes if sha.strip('0')]
+                    for (sha, path), content in zip(changes, self._cat_blobs([sha for sha, path in changes])):
+                        self._index_log(path, content)
+                    self._set_state('commit', commit)
+                self._index_journal()
+
+    def _index_journal(self):
+        last_mtime = int(self._state('journal_mtime') or 0)
+        max_mtime = last_mtime
+        for journal in ('journal', 'journal-private'):
+            journal_dir = os.path.join(self.git_dir, 'annex', journal)
+            try:
+                entries = list(os.scandir(journal_dir))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                path = self.journal2path(entry.name)
+                # journalled key logs keep their hash directories
+                if not path.endswith(WEB_LOG_SUFFIX) and not ('/' in path and path.endswith(LOCATION_LOG_SUFFIX)):
+                    continue
+                try:
+                    mtime = entry.stat().st_mtime_ns
+                    if mtime < last_mtime:
+                        continue
+                    with open(entry.path, 'rt') as log:
+                        content = log.read()
+                except FileNotFoundError:
+                    continue # committed to the branch meanwhile
+                max_mtime = max(max_mtime, mtime)
+                self._index_log(path, content)
+        self._set_state('journal_mtime', str(max_mtime))
+
+    def _index_log(self, path, content):
+        # lines are '<timestamp>[s] <1|0|X> <url>', ':' prefixes uris of other downloaders
+        # and in location logs, '<timestamp>[s] <1|0|X> <uuid>'
+        key = self.path2key(path)
+        update = self._update if path.endswith(WEB_LOG_SUFFIX) else self._update_location
+        for line in content.split('\n'):
+            parts = line.split(' ', 2)
+            if len(parts) < 3:
+                continue
+            timestamp, state, url = parts
+            if timestamp.endswith('s'):
+                timestamp = timestamp[:-1]
+            try:
+                timestamp = float(timestamp)
+            except ValueError:
+                continue
+            update(key, url, state == '1', timestamp)
+
+    def _update(self, key, url, present, timestamp):
+        self.db.execute(
+            'INSERT INTO urls VALUES (?, ?, ?, ?) ON CONFLICT (key, url) DO UPDATE SET present = excluded.present, timestamp = excluded.timestamp WHERE excluded.timestamp >= urls.timestamp',
+            (key, url, int(present), timestamp)
+        )
+
+    def _update_location(self, key, uuid, present, timestamp):
+        self.db.execute(
+            'INSERT INTO locations VALUES (?, ?, ?, ?, ?) ON CONFLICT (key, uuid) DO UPDATE SET'
+            ' present = CASE WHEN excluded.timestamp >= locations.timestamp THEN excluded.present ELSE locations.present END,'
+            ' timestamp = MAX(excluded.timestamp, locations.timestamp),'
+            ' present_timestamp = NULLIF(MAX(COALESCE(excluded.present_timestamp, 0), COALESCE(locations.present_timestamp, 0)), 0)',
+            (key, uuid, int(present), timestamp, timestamp if present else None)
+        )
+
+    def _state(self, name):
+        row = self.db.execute('SELECT value FROM state WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def _set_state(self, name, value):
+        self.db.execute('INSERT OR REPLACE INTO state VALUES (?, ?)', (name, value))
+
+    def _git(self, *params):
+        return subprocess.run(
+            ('git', '--git-dir', self.git_dir, *params),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True
+        ).stdout
+
+    def _cat_blobs(self, shas):
+        if not shas:
+            return
+        proc = subprocess.Popen(
+            ('git', '--git-dir', self.git_dir, 'cat-file', '--batch'),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE
+        )
+        writer = threading.Thread(target=self._write_lines, args=(proc.stdin, shas))
+        writer.start()
+        try:
+            for sha in shas:
+                header = proc.stdout.readline().split()
+                size = int(header[2])
+                content = proc.stdout.read(size)
+                proc.stdout.read(1)
+                yield content.decode(errors='replace')
+        finally:
+            writer.join()
+            proc.stdout.close()
+            proc.wait()
+
+    @staticmethod
+    def _write_lines(stream, lines):
+        for line in lines:
+            stream.write(line.encode() + b'\n')
+        stream.close()
+
+    @staticmethod
+    def journal2path(filename):
+        '''The branch path of a journal file, whose name git-annex makes by writing '_' as '__' and then '/' as '_'.'''
+        return filename.replace('_', '/').replace('//', '_')
+
+    @staticmethod
+    def path2key(path):
+        '''Unescape a key from the filename of its log, as git-annex escapes them.'''
+        filename = path.rsplit('/', 1)[-1]
+        for suffix in (WEB_LOG_SUFFIX, LOCATION_LOG_SUFFIX):
+            if filename.endswith(suffix):
+                filename = filename[:-len(suffix)]
+                break
+        return filename.replace('%', '/').replace('&c', ':').replace('&s', '%').replace('&a', '&')
+
+class IndexedAnnex:
+    '''Wraps an annexremote Master so that url lookups are answered from a UrlIndex
+    and url changes are written through to it.'''
+
+    def __init__(self, annex, git_dir = None):
+        self.annex = annex
+        self.url_index = UrlIndex(git_dir or annex.getgitdir())
+
+    def __getattr__(self, name):
+        return getattr(self.annex, name)
+
+    def geturls(self, key, prefix):
+        urls = self.url_index.urls(key, prefix)
+        if not urls:
+            # the key may not be logged yet, let git-annex say for sure
+            urls = self.annex.geturls(key, prefix)
+        return urls
+
+    def seturlpresent(self, key, url):
+        self.url_index.set_present(key, url)
+        return self.annex.seturlpresent(key, url)
+
+    def seturlmissing(self, key, url):
+        self.url_index.set_missing(key, url)
+        return self.annex.seturlmissing(key, url)
+
+    def seturipresent(self, key, uri):
+        self.url_index.set_present(key, uri, uri=True)
+        return self.annex.seturipresent(key, uri)
+
+    def seturimissing(self, key, uri):
+        self.url_index.set_missing(key, uri, uri=True)
+        return self.annex.seturimissing(key, uri)
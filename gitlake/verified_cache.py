@@ -0,0 +1,48 @@
+import os, sqlite3, threading, time
+
+class VerifiedCache:
+    '''A persistent record of content ids a remote was seen to hold, and their lengths.
+    Entries marked permanent, such as transactions buried deep enough in a chain, are trusted forever.
+    Others are trusted for ttl seconds after they were verified, and are checked again after that.
+    '''
+
+    def __init__(self, path, ttl = 24 * 60 * 60):
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS verified (id TEXT PRIMARY KEY, length INTEGER, permanent INTEGER, verified REAL)')
+
+    def lengths(self, ids):
+        '''A dict mapping those of ids still trusted to their lengths, which are None when unknown.'''
+        ids = list(ids)
+        result = {}
+        expiry = time.time() - self.ttl
+        with self.lock:
+            # sqlite limits the number of parameters in one statement
+            for offset in range(0, len(ids), 512):
+                batch = ids[offset:offset+512]
+                result.update(self.db.execute(
+                    f'SELECT id, length FROM verified WHERE (permanent OR verified > ?) AND id IN ({",".join("?" * len(batch))})',
+                    (expiry, *batch)
+                ).fetchall())
+        return result
+
+    def add(self, id, length, permanent = False):
+        self.add_many({id: length}, permanent)
+
+    def add_many(self, lengths, permanent = False):
+        '''Record ids, mapped to their lengths, as verified now.'''
+        now = time.time()
+        with self.lock, self.db:
+            # a permanent entry stays permanent if the id is verified again less conclusively
+            self.db.executemany(
+                'INSERT INTO verified VALUES (?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET length = excluded.length, permanent = permanent OR excluded.permanent, verified = excluded.verified',
+                ((id, length, bool(permanent), now) for id, length in lengths.items())
+            )
+
+    def forget(self, *ids):
+        '''Drop ids, such as when their content was found missing.'''
+        with self.lock, self.db:
+            self.db.executemany('DELETE FROM verified WHERE id = ?', ((id,) for id in ids))
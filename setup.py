@@ -15,6 +15,7 @@ setup(name='gitlake',
           'scripts/git-annex-remote-arkb-subprocess',
           'scripts/git-remote-arkb-subprocess',
           'scripts/git-annex-remote-w3-subprocess',
+          'scripts/w3-annex-helper',
 #          'scripts/git-annex-remote-w3-hybrid'
       ],
       install_requires=[
@@ -26,5 +27,6 @@ setup(name='gitlake',
           'graphene',
           'pyarweave @ git+https://github.com/xloem/pyarweave',
           'yarl39',
+          'requests',
       ],
 )